@@ -35,6 +35,9 @@
 #This code requires the external frequent itemset mining package "PyFIM," 
 #available at http://www.borgelt.net/pyfim.html
 #
+#If the package "pyroaring" is installed, the sets of data points satisfying 
+#each rule are stored as Roaring bitmaps instead of Python sets.
+#
 #It is specific to binary classification with binary features (although could 
 #easily be extended to multiclass).
 #
@@ -91,12 +94,20 @@
 
 from numpy import *
 import os,time,json,traceback,sys
+import multiprocessing
 from scipy.special import gammaln
 from scipy.stats import poisson,beta
 import cPickle as Pickle
 from collections import defaultdict,Counter
 from fim import fpgrowth #this is PyFIM, available from http://www.borgelt.net/pyfim.html
 from joblib import Parallel, delayed
+from brl_core import _rule_usage, class_bitsets
+
+try:
+    #Roaring bitmaps: compressed sets of data indices with fast intersection and difference
+    from pyroaring import BitMap as IndexSet
+except ImportError:
+    IndexSet = set
 
 try:
     from matplotlib import pyplot as plt
@@ -194,47 +205,66 @@ def run_bdl_multichain_serial(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs
     #plot_chains(res)
     return res,Rhat
 
+#Run a single chain in a worker process. Each worker is given its own seed, since
+#forked workers would otherwise all start from the parent's RNG state.
+def _run_single_chain(args):
+    seed,chain_args = args
+    random.seed(seed)
+    return mcmcchain(*chain_args)
+
+#Run mcmc for each of the chains, in parallel across n_workers processes.
+#Falls back to the serial version when there is only one worker, or when called
+#from a daemonic process (e.g. a Pool worker), which is not allowed to have children.
+def run_bdl_multichain_parallel(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,permsdic,burnin,nchains,d_inits,n_workers=None,verbose=True):
+    if n_workers is None:
+        n_workers = min(nchains,multiprocessing.cpu_count())
+    if n_workers <= 1 or multiprocessing.current_process().daemon:
+        return run_bdl_multichain_serial(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,permsdic,burnin,nchains,d_inits,verbose)
+    t1 = time.time()
+    if verbose:
+        print 'Starting mcmc chains'
+    seeds = random.randint(0,2**31-1,nchains) #drawn from the parent RNG, so seeding it makes the run reproducible
+    args = [(seeds[n],(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,permsdic,burnin,nchains,d_inits[n])) for n in range(nchains)]
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        res = dict(enumerate(pool.map(_run_single_chain,args)))
+    finally:
+        pool.close()
+        pool.join()
+        
+    if verbose:
+        print 'Elapsed wall time',time.time()-t1
+
+    #Check convergence
+    Rhat = gelmanrubin(res)
+    
+    if verbose:
+        print 'Rhat for convergence:',Rhat
+    return res,Rhat
+
 def mcmcchain(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,permsdic,burnin,nchains,d_init):
     res = {}
-    permsdic,res['perms'] = bayesdl_mcmc(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,permsdic,burnin,None,d_init)
-    #Store the permsdic results
-    res['permsdic'] = {perm:list(vals) for perm,vals in permsdic.iteritems() if vals[1]>0}
+    permsdic,perms = bayesdl_mcmc(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,permsdic,burnin,None,d_init)
+    #Store the samples as arrays: sample t is the antecedent list keys[perms[t]], with log posterior logpost[perms[t]]
+    res['keys'],res['perms'] = unique(array(perms,dtype=object),return_inverse=True)
+    res['perms'] = res['perms'].astype(int32)
+    res['logpost'] = array([permsdic[perm][0] for perm in res['keys']])
     #Reset the permsdic
     permsdic = reset_permsdic(permsdic)
     return res
 
 #Check convergence with GR diagnostic
 def gelmanrubin(res):
-    n = 0 #number of samples per chain - to be computed
-    m = len(res) #number of chains
-    phi_bar_j = {}
-    for chain in res:
-        phi_bar_j[chain] = 0.
-        for val in res[chain]['permsdic'].itervalues():
-            phi_bar_j[chain] += val[1]*val[0] #numsamples*log posterior
-            n += val[1]
-    #And normalize
-    n = n//m #Number of samples per chain (assuming all m chains have same number of samples)
+    phi = [res[chain]['logpost'][res[chain]['perms']] for chain in res] #log posterior of each sample, per chain
+    m = len(phi) #number of chains
+    n = sum([len(phi_j) for phi_j in phi])//m #Number of samples per chain (assuming all m chains have same number of samples)
     #Normalize, and compute phi_bar
-    phi_bar = 0.
-    for chain in phi_bar_j:
-        phi_bar_j[chain] = phi_bar_j[chain]/float(n) #normalize
-        phi_bar += phi_bar_j[chain]
-    phi_bar = phi_bar/float(m) #phi_bar = average of phi_bar_j
+    phi_bar_j = array([phi_j.sum()/float(n) for phi_j in phi])
+    phi_bar = phi_bar_j.mean() #phi_bar = average of phi_bar_j
     #Now B
-    B = 0.
-    for chain in phi_bar_j:
-        B += (phi_bar_j[chain] - phi_bar)**2
-    B = B*(n/float(m-1))
+    B = ((phi_bar_j - phi_bar)**2).sum()*(n/float(m-1))
     #Now W.
-    W = 0.
-    for chain in res:
-        s2_j = 0.
-        for val in res[chain]['permsdic'].itervalues():
-            s2_j += val[1]*(val[0] -phi_bar_j[chain])**2
-        s2_j = (1./float(n-1))*s2_j
-        W += s2_j
-    W = W*(1./float(m))
+    W = mean([((phi_j - phi_bar_j[j])**2).sum()/float(n-1) for j,phi_j in enumerate(phi)])
     #Next varhat
     varhat = ((n-1)/float(n))*W + (1./float(n))*B
     #And finally,
@@ -248,17 +278,21 @@ def gelmanrubin(res):
 #Plot the logposterior values for the samples in the chains.
 def plot_chains(res):
     for chain in res:
-        plt.plot([res[chain]['permsdic'][a][0] for a in res[chain]['perms']])
+        plt.plot(res[chain]['logpost'][res[chain]['perms']])
     plt.show()
     return
 
 #Merge chains into a single collection of posterior samples
 def merge_chains(res):
+    keys = concatenate([res[n]['keys'] for n in res])
+    logpost = concatenate([res[n]['logpost'] for n in res])
+    counts = concatenate([bincount(res[n]['perms'],minlength=len(res[n]['keys'])) for n in res])
+    #Chains that visited the same antecedent list share a key; add up their sample counts
+    keys,first,inverse = unique(keys,return_index=True,return_inverse=True)
+    counts = bincount(inverse,weights=counts,minlength=len(keys))
     permsdic = defaultdict(default_permsdic)
-    for n in res:
-        for perm,vals in res[n]['permsdic'].iteritems():
-            permsdic[perm][0] = vals[0]
-            permsdic[perm][1] += vals[1]
+    for perm,lp,count in zip(keys,logpost[first],counts):
+        permsdic[perm] = [lp,count]
     return permsdic
 
 #Get a point estimate with length and width similar to the posterior average, with highest likelihood
@@ -287,6 +321,7 @@ def get_point_estimate(permsdic,lhs_len,X,Y,alpha,nruleslen,maxlhs,lbda,eta,verb
         likelihds = []
         d_ts = []
         beta_Z,logalpha_pmf,logbeta_pmf = prior_calculations(lbda,len(X),eta,maxlhs) #get the constants needed to compute the prior
+        Y_bits = class_bitsets(Y) if isinstance(X,ndarray) else None
         for perm in permsdic:
             if permsdic[perm][1]>0:
                 d_t = Pickle.loads(perm) #this is the antecedent list
@@ -298,7 +333,7 @@ def get_point_estimate(permsdic,lhs_len,X,Y,alpha,nruleslen,maxlhs,lbda,eta,verb
                         d_ts.append(d_t)
                         #Compute the likelihood
                         R_t = d_t.index(0)
-                        N_t = compute_rule_usage(d_t,R_t,X,Y)
+                        N_t = compute_rule_usage(d_t,R_t,X,Y,Y_bits)
                         likelihds.append(fn_logposterior(d_t,R_t,N_t,alpha,logalpha_pmf,logbeta_pmf,maxlhs,beta_Z,nruleslen,lhs_len))
         likelihds = array(likelihds)
         d_star = d_ts[likelihds.argmax()]
@@ -329,12 +364,12 @@ def get_rule_rhs(Xtrain,Ytrain,d_t,alpha,intervals):
 #Get predictions from the list d_t
 def preds_d_t(X,Y,d_t,theta):
     #this is binary only. The score is the Prob of 1.
-    unused = set(range(Y.shape[0]))
+    unused = type(X[0])(range(Y.shape[0])) #same set type as X (set or IndexSet)
     preds = -1*ones(Y.shape[0])
     for i,j in enumerate(d_t):
-        usedj = unused.intersection(X[j]) #these are the observations in X that make it to rule j
+        usedj = unused & X[j] #these are the observations in X that make it to rule j
         preds[list(usedj)] = theta[i]
-        unused = unused.difference(set(usedj))
+        unused = unused - usedj
     if preds.min() < 0:
         raise Exception #this means some observation wasn't given a prediction - shouldn't happen
     return preds
@@ -352,11 +387,11 @@ def preds_full_posterior(X,Y,Xtrain,Ytrain,permsdic,alpha):
         #We will get the posterior E[theta]'s for this list
         theta,jnk = get_rule_rhs(Xtrain,Ytrain,d_t,alpha,False)
         #And assign observations a score
-        unused = set(range(Y.shape[0]))
+        unused = type(X[0])(range(Y.shape[0]))
         for i,j in enumerate(d_t):
-            usedj = unused.intersection(X[j]) #these are the observations in X that make it to rule j
+            usedj = unused & X[j] #these are the observations in X that make it to rule j
             preds[list(usedj)] += theta[i]*permcount
-            unused = unused.difference(set(usedj))
+            unused = unused - usedj
         if unused:
             raise Exception #all observations should have been given predictions
         #Done with this list, move on to the next one.
@@ -386,19 +421,21 @@ def bayesdl_mcmc(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,p
         random.seed(rseed)
     #Do some pre-computation for the prior
     beta_Z,logalpha_pmf,logbeta_pmf = prior_calculations(lbda,len(X),eta,maxlhs)
+    Y_bits = class_bitsets(Y) if isinstance(X,ndarray) else None #the labels are fixed, so pack them once
     if d_init: #If we want to begin our chain at a specific place (e.g. to continue a chain)
         d_t = Pickle.loads(d_init)
         d_t.extend([i for i in range(len(X)) if i not in d_t])
         R_t = d_t.index(0)
-        N_t = compute_rule_usage(d_t,R_t,X,Y)
+        N_t = compute_rule_usage(d_t,R_t,X,Y,Y_bits)
     else:
-        d_t,R_t,N_t = initialize_d(X,Y,lbda,eta,lhs_len,maxlhs,nruleslen) #Otherwise sample the initial value from the prior
+        d_t,R_t,N_t = initialize_d(X,Y,lbda,eta,lhs_len,maxlhs,nruleslen,Y_bits) #Otherwise sample the initial value from the prior
     #Add to dictionary which will store the sampling results
     a_t = Pickle.dumps(d_t[:R_t+1]) #The antecedent list in string form
     if a_t not in permsdic:
         permsdic[a_t][0] = fn_logposterior(d_t,R_t,N_t,alpha,logalpha_pmf,logbeta_pmf,maxlhs,beta_Z,nruleslen,lhs_len) #Compute its logposterior
     if burnin == 0:
         permsdic[a_t][1] += 1 #store the initialization sample
+        perms.append(a_t)
     #iterate!
     for itr in range(numiters):
         #Sample from proposal distribution
@@ -406,7 +443,7 @@ def bayesdl_mcmc(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,p
         #Compute the new posterior value, if necessary
         a_star = Pickle.dumps(d_star[:R_star+1])
         if a_star not in permsdic:
-            N_star = compute_rule_usage(d_star,R_star,X,Y)
+            N_star = compute_rule_usage(d_star,R_star,X,Y,Y_bits)
             permsdic[a_star][0] = fn_logposterior(d_star,R_star,N_star,alpha,logalpha_pmf,logbeta_pmf,maxlhs,beta_Z,nruleslen,lhs_len)
         #Compute the metropolis acceptance probability
         q = exp(permsdic[a_star][0] - permsdic[a_t][0] + Jratio)
@@ -424,13 +461,13 @@ def bayesdl_mcmc(numiters,thinning,alpha,lbda,eta,X,Y,nruleslen,lhs_len,maxlhs,p
     return permsdic,perms
 
 #Samples a list from the prior
-def initialize_d(X,Y,lbda,eta,lhs_len,maxlhs,nruleslen):
+def initialize_d(X,Y,lbda,eta,lhs_len,maxlhs,nruleslen,Y_bits=None):
     m = Inf
     while m>=len(X):
         m = poisson.rvs(lbda) #sample the length of the list from Poisson(lbda), truncated at len(X)
     #prepare the list
     d_t = []
-    empty_rulelens = [r for r in range(1,maxlhs+1) if r not in nruleslen]
+    empty_rulelens = [r for r in range(1,maxlhs+1) if nruleslen[r] == 0]
     used_rules = []
     for i in range(m):
         #Sample a rule size.
@@ -453,7 +490,7 @@ def initialize_d(X,Y,lbda,eta,lhs_len,maxlhs,nruleslen):
     R_t = d_t.index(0)
     assert R_t == m
     #Figure out what rules are used to classify what points
-    N_t = compute_rule_usage(d_t,R_t,X,Y)
+    N_t = compute_rule_usage(d_t,R_t,X,Y,Y_bits)
     return d_t,R_t,N_t
 
 #Propose a new d_star
@@ -591,17 +628,24 @@ def fn_logprior(d_t,R_t,logalpha_pmf,logbeta_pmf,maxlhs,beta_Z,nruleslen,lhs_len
     #All done
     return logprior
 
-#Compute which rules are being used to classify data points with what labels
-def compute_rule_usage(d_star,R_star,X,Y):
-    N_star = zeros((R_star+1,Y.shape[1]))
-    remaining_unused = set(range(Y.shape[0]))
-    i = 0
-    while remaining_unused:
-        j = d_star[i]
-        usedj = remaining_unused.intersection(X[j])
-        remaining_unused = remaining_unused.difference(set(usedj))
-        N_star[i,:] = Y[list(usedj),:].sum(0)
-        i+=1
+#Compute which rules are being used to classify data points with what labels.
+#Y_bits is class_bitsets(Y), for callers that compute the usage many times with the same labels.
+def compute_rule_usage(d_star,R_star,X,Y,Y_bits=None):
+    if isinstance(X,ndarray):
+        #X is the bit-packed data-vs.-lhs matrix, use the compiled kernel
+        if Y_bits is None:
+            Y_bits = class_bitsets(Y)
+        N_star = _rule_usage(array(d_star[:R_star+1],dtype=int64),X,Y_bits)
+    else:
+        N_star = zeros((R_star+1,Y.shape[1]))
+        remaining_unused = type(X[0])(range(Y.shape[0])) #same set type as X (set or IndexSet)
+        i = 0
+        while remaining_unused:
+            j = d_star[i]
+            usedj = remaining_unused & X[j]
+            remaining_unused = remaining_unused - usedj
+            N_star[i,:] = Y[list(usedj),:].sum(0)
+            i+=1
     if int(sum(N_star)) != Y.shape[0]:
         raise Exception #bug check
     return N_star
@@ -631,16 +675,18 @@ def get_freqitemsets(fname,minsupport,maxlhs, verbose=True):
         print len(itemsets),'rules mined'
     #Now form the data-vs.-lhs set
     #X[j] is the set of data points that contain itemset j (that is, satisfy rule j)
-    X = [ set() for j in range(len(itemsets)+1)]
-    X[0] = set(range(len(data))) #the default rule satisfies all data
+    X = [ IndexSet() for j in range(len(itemsets)+1)]
+    X[0] = IndexSet(range(len(data))) #the default rule satisfies all data
+    xi_sets = [frozenset(xi) for xi in data] #build each set once, not once per rule
     for (j,lhs) in enumerate(itemsets):
-        X[j+1] = set([i for (i,xi) in enumerate(data) if set(lhs).issubset(xi)])
+        lhs_set = frozenset(lhs)
+        X[j+1] = IndexSet([i for (i,xi) in enumerate(xi_sets) if xi >= lhs_set])
     #now form lhs_len
     lhs_len = [0]
     for lhs in itemsets:
         lhs_len.append(len(lhs))
-    nruleslen = Counter(lhs_len)
     lhs_len = array(lhs_len)
+    nruleslen = bincount(lhs_len,minlength=maxlhs+1) #nruleslen[k] is the number of rules of length k
     itemsets_all = ['null']
     itemsets_all.extend(itemsets)
     return X,Y,nruleslen,lhs_len,itemsets_all
@@ -652,11 +698,13 @@ def get_testdata(fname,itemsets):
     data,Y = load_data(fname)
     #Now form the data-vs.-lhs set
     #X[j] is the set of data points that contain itemset j (that is, satisfy rule j)
-    X = [set() for j in range(len(itemsets))]
-    X[0] = set(range(len(data))) #the default rule satisfies all data
+    X = [IndexSet() for j in range(len(itemsets))]
+    X[0] = IndexSet(range(len(data))) #the default rule satisfies all data
+    xi_sets = [frozenset(xi) for xi in data] #build each set once, not once per rule
     for (j,lhs) in enumerate(itemsets):
         if j>0:
-            X[j] = set([i for (i,xi) in enumerate(data) if set(lhs).issubset(xi)])
+            lhs_set = frozenset(lhs)
+            X[j] = IndexSet([i for (i,xi) in enumerate(xi_sets) if xi >= lhs_set])
     Ylabels = [list(i).index(1) for i in Y]
     return X,Y,Ylabels
 
@@ -0,0 +1,84 @@
+#Bit-packed representation of the data-vs.-lhs sets used by BRL.
+#
+#Row j of a bitset matrix is the set of data points satisfying rule j, packed
+#one bit per data point into uint64 words, so that set intersection is a
+#vectorized bitwise_and and set cardinality is a popcount.
+
+import numpy as np
+from joblib import Parallel, delayed
+
+#Pack the rows of a boolean matrix (n_rows x n_points) into uint64 words
+def pack_rows(B):
+    B = np.asarray(B, dtype=bool)
+    n = B.shape[1]
+    packed = np.zeros((B.shape[0], 8*((n+63)//64)), dtype=np.uint8)
+    packed[:, :(n+7)//8] = np.packbits(B, axis=1)
+    return packed.view(np.uint64)
+
+#Unpack a bitset matrix back into a boolean matrix with n columns
+def unpack_rows(bits, n):
+    bits = np.ascontiguousarray(bits)
+    return np.unpackbits(bits.view(np.uint8), axis=-1)[..., :n].astype(bool)
+
+#Number of data points in each bitset
+def popcount(bits):
+    bits = np.ascontiguousarray(bits)
+    return np.unpackbits(bits.view(np.uint8), axis=-1).sum(axis=-1)
+
+#The bitset containing all n data points (the default rule)
+def full_bitset(n):
+    return pack_rows(np.ones((1, n), dtype=bool))[0]
+
+#One bitset per item, built in a single pass over the data. index maps item -> row.
+def item_columns(data, index):
+    rows = []
+    cols = []
+    for i, xi in enumerate(data):
+        for item in xi:
+            r = index.get(item)
+            if r is not None:
+                rows.append(r)
+                cols.append(i)
+    B = np.zeros((len(index), len(data)), dtype=bool)
+    B[rows, cols] = True
+    return pack_rows(B)
+
+#Inverted index for a list of itemsets: index maps item -> row, and row j of
+#rule_items lists the item rows of itemset j. Shorter itemsets are padded with
+#the extra row len(index), which itemset_bitsets fills with all data points.
+#If support (item -> number of data points) is given, the items of each itemset
+#are ordered rarest first, so that _and_reduce can stop early.
+def itemset_index(itemsets, support=None):
+    index = {}
+    for lhs in itemsets:
+        for item in lhs:
+            index.setdefault(item, len(index))
+    width = max([len(lhs) for lhs in itemsets] + [1])
+    rule_items = np.full((len(itemsets), width), len(index), dtype=np.intp)
+    for (j, lhs) in enumerate(itemsets):
+        if support is not None:
+            lhs = sorted(lhs, key=lambda item: support.get(item, 0))
+        rule_items[j, :len(lhs)] = [index[item] for item in lhs]
+    return index, rule_items
+
+#AND of the item columns of each row of rule_items, one item position at a time.
+#Rules that are already satisfied by no data point (or have no more items) are
+#skipped, which prunes most of the work when the rarest item comes first.
+def _and_reduce(cols, rule_items):
+    pad = cols.shape[0]-1
+    bits = cols[rule_items[:, 0]]
+    for k in range(1, rule_items.shape[1]):
+        live = np.flatnonzero((rule_items[:, k] != pad) & bits.any(axis=1))
+        bits[live] &= cols[rule_items[live, k]]
+    return bits
+
+#Bitsets of the data points satisfying each itemset, i.e. the AND of its item columns.
+#With n_jobs != 1, blocks of chunk itemsets are reduced in parallel threads (numpy
+#releases the GIL in the reductions, so threads scale without copying cols).
+def itemset_bitsets(data, index, rule_items, n_jobs=1, chunk=1024):
+    cols = np.vstack((item_columns(data, index), full_bitset(len(data))))
+    if n_jobs == 1 or len(rule_items) <= chunk:
+        return _and_reduce(cols, rule_items)
+    blocks = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_and_reduce)(cols, rule_items[start:start+chunk]) for start in range(0, len(rule_items), chunk))
+    return np.vstack(blocks)
@@ -0,0 +1,53 @@
+#Compiled kernels for the inner step of the BRL MCMC.
+#
+#These operate on the bit-packed data-vs.-lhs matrix from bitsets.py instead of
+#lists of Python sets. numba is optional: if it is installed the kernels are
+#jit-compiled, otherwise the same code runs on numpy.
+
+import numpy as np
+from bitsets import pack_rows, popcount as popcount_numpy
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    #without numba, leave the kernels as plain python/numpy functions
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+if HAVE_NUMBA:
+    #Number of set bits in a bitset (SWAR popcount of each word)
+    @njit(cache=True)
+    def popcount(bits):
+        total = 0
+        for w in bits:
+            w = w - ((w >> np.uint64(1)) & _M1)
+            w = (w & _M2) + ((w >> np.uint64(2)) & _M2)
+            w = (w + (w >> np.uint64(4))) & _M4
+            total += np.int64((w * _H01) >> np.uint64(56))
+        return total
+else:
+    popcount = popcount_numpy
+
+#N_star[i,k] is the number of data points of class k captured by rule d_star[i],
+#where class_bitsets[k] is the bitset of the data points of class k
+@njit(cache=True)
+def _rule_usage(d_star, item_bitsets, class_bitsets):
+    N_star = np.zeros((d_star.shape[0], class_bitsets.shape[0]))
+    remaining_unused = item_bitsets[0].copy() #the default rule satisfies all data
+    for i in range(d_star.shape[0]):
+        usedj = remaining_unused & item_bitsets[d_star[i]]
+        remaining_unused = remaining_unused & ~usedj
+        for k in range(class_bitsets.shape[0]):
+            N_star[i, k] = popcount(usedj & class_bitsets[k])
+    return N_star
+
+#Bitsets of the data points of each class (row k is class k), for the one-hot labels Y
+def class_bitsets(Y):
+    return pack_rows(np.asarray(Y).T)
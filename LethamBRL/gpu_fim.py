@@ -0,0 +1,89 @@
+#Frequent itemset mining on the GPU.
+#
+#The transactions are one-hot encoded into an (n_transactions x n_items) boolean
+#matrix on the device, and itemsets are grown one level at a time (Apriori): the
+#support of a candidate is the number of rows in which all of its item columns
+#are set. Only the frequent itemsets are copied back to the host. Results are
+#the itemsets PyFIM's fpgrowth(..., report='') finds, in the same form (a list of
+#1-tuples holding an itemset), though not in the same order.
+#
+#The GPU path requires cupy. apriori_dense runs the same code on any numpy-like
+#array module.
+
+from itertools import combinations
+import numpy as np
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+#Whether the GPU backend can be used
+def gpu_available():
+    return cupy is not None
+
+#Copy an array back to the host
+def _to_host(a, xp):
+    return a if xp is np else xp.asnumpy(a)
+
+#Candidate (k+1)-itemsets from the frequent k-itemsets (sorted tuples of item codes):
+#join itemsets sharing their first k-1 items, and keep the candidates all of whose
+#k-subsets are frequent
+def _candidates(frequent):
+    fset = set(frequent)
+    prefixes = {}
+    for lhs in frequent:
+        prefixes.setdefault(lhs[:-1], []).append(lhs[-1])
+    cands = []
+    for prefix, last in prefixes.iteritems():
+        for (a, b) in combinations(sorted(last), 2):
+            cand = prefix + (a, b)
+            if all(cand[:i] + cand[i+1:] in fset for i in range(len(cand)-2)):
+                cands.append(cand)
+    return cands
+
+#Number of transactions containing each candidate, evaluated in chunks to bound device memory
+def _support(T, cands, xp, chunk_bytes=2**27):
+    chunk = max(1, chunk_bytes//(T.shape[0]*len(cands[0])))
+    supports = []
+    for start in range(0, len(cands), chunk):
+        C = xp.asarray(np.array(cands[start:start+chunk], dtype=np.intp))
+        supports.append(_to_host(T[:, C].all(axis=2).sum(axis=0), xp))
+    return np.concatenate(supports)
+
+#Frequent itemsets of the transactions tracts with Apriori on a dense one-hot matrix.
+#supp is the minimum support as a percentage (or an absolute count if negative), as in fpgrowth.
+#Like fpgrowth, itemsets contained in every transaction (i.e. made only of items that occur
+#everywhere) are not reported, though they are still extended to larger itemsets.
+def apriori_dense(tracts, supp=10, zmax=None, xp=np):
+    rows = [i for (i, t) in enumerate(tracts) for item in t]
+    flat = [item for t in tracts for item in t]
+    if not flat:
+        return []
+    items, cols = np.unique(flat, return_inverse=True)
+    items = items.tolist()
+    T = xp.zeros((len(tracts), len(items)), dtype=bool)
+    T[xp.asarray(rows), xp.asarray(cols)] = True
+    if supp < 0:
+        smin = -supp
+    else:
+        smin = int(np.ceil(supp*len(tracts)/100.))
+    if zmax is None:
+        zmax = len(items)
+    support = _to_host(T.sum(axis=0), xp)
+    frequent = [(j,) for j in np.flatnonzero(support >= smin).tolist()]
+    found = [(j,) for j in np.flatnonzero((support >= smin) & (support < len(tracts))).tolist()]
+    while frequent and len(frequent[0]) < zmax:
+        cands = _candidates(frequent)
+        if not cands:
+            break
+        support = _support(T, cands, xp)
+        frequent = [cand for (cand, s) in zip(cands, support) if s >= smin]
+        found.extend(cand for (cand, s) in zip(cands, support) if smin <= s < len(tracts))
+    return [(tuple(items[j] for j in lhs),) for lhs in found]
+
+#Frequent itemsets of the transactions tracts, mined on the GPU
+def fpgrowth_gpu(tracts, supp=10, zmax=None):
+    if cupy is None:
+        raise ImportError('the gpu itemset mining backend requires cupy')
+    return apriori_dense(tracts, supp=supp, zmax=zmax, xp=cupy)
@@ -2,9 +2,12 @@ from sklearn.base import BaseEstimator
 from sklearn.utils import check_X_y
 import sklearn.metrics
 import sys
+from itertools import chain, izip
 import numpy as np
 import pandas as pd
 from LethamBRL.BRL_code import *
+from LethamBRL.gpu_fim import fpgrowth_gpu, gpu_available
+from LethamBRL.bitsets import itemset_index, itemset_bitsets, full_bitset, unpack_rows
 from Discretization.MDLP import *
 
 class RuleListClassifier(BaseEstimator):
@@ -27,7 +30,7 @@ class RuleListClassifier(BaseEstimator):
         
     minsupport : int, optional (default=10)
         Minimum support (%) of an itemset
-
+        
     alpha : array_like, shape = [n_classes]
         prior hyperparameter for multinomial pseudocounts
 
@@ -42,9 +45,20 @@ class RuleListClassifier(BaseEstimator):
         
     verbose: bool, optional (default=True)
         Verbose output
+        
+    n_workers : int, optional (default=None)
+        Number of processes used to run the MCMC chains in parallel, and of
+        threads used to build the rule-satisfaction bitsets. If None,
+        min(n_chains, number of CPUs) processes and all CPUs for threads
+        are used; 1 runs everything serially.
+        
+    fpgrowth_backend : str, optional (default="cpu")
+        Frequent itemset miner: "cpu" uses PyFIM's fpgrowth, "gpu" mines on
+        the GPU with cupy (falling back to "cpu" if cupy is not installed).
+        The GPU pays off for large datasets with a low minsupport.
     """
     
-    def __init__(self, listlengthprior=3, listwidthprior=1, maxcardinality=2, minsupport=10, alpha = np.array([1.,1.]), n_chains=3, max_iter=50000, class1label="class 1", verbose=True):
+    def __init__(self, listlengthprior=3, listwidthprior=1, maxcardinality=2, minsupport=10, alpha = np.array([1.,1.]), n_chains=3, max_iter=50000, class1label="class 1", verbose=True, n_workers=None, fpgrowth_backend="cpu"):
         self.listlengthprior = listlengthprior
         self.listwidthprior = listwidthprior
         self.maxcardinality = maxcardinality
@@ -54,12 +68,15 @@ class RuleListClassifier(BaseEstimator):
         self.max_iter = max_iter
         self.class1label = class1label
         self.verbose = verbose
+        self.n_workers = n_workers
+        self.fpgrowth_backend = fpgrowth_backend
         
         self.thinning = 1 #The thinning rate
         self.burnin = self.max_iter//2 #the number of samples to drop as burn-in in-simulation
         
         self.discretizer = None
         self.d_star = None
+        self._str_cache = None
         
         
     def fit(self, X, y, feature_labels = None): # -1 for unlabeled
@@ -82,6 +99,8 @@ class RuleListClassifier(BaseEstimator):
         """
         if len(set(y)) != 2:
             raise Exception("Only binary classification is supported at this time!")
+        if self.fpgrowth_backend not in ("cpu", "gpu"):
+            raise ValueError("fpgrowth_backend must be \"cpu\" or \"gpu\", got %r" % (self.fpgrowth_backend,))
         X, y = check_X_y(X, y, ensure_min_samples=2, estimator=self)
         
         if feature_labels == None:
@@ -97,40 +116,45 @@ class RuleListClassifier(BaseEstimator):
         
         permsdic = defaultdict(default_permsdic) #We will store here the MCMC results
         
-        data = list(X[:])
+        data = X #X is a list of transactions by now, only read from here on
         #Now find frequent itemsets
         #Mine separately for each class
         data_pos = [x for i,x in enumerate(data) if y[i]==0]
         data_neg = [x for i,x in enumerate(data) if y[i]==1]
         assert len(data_pos)+len(data_neg) == len(data)
-        try:
-            itemsets = [r[0] for r in fpgrowth(data_pos,supp=self.minsupport,zmax=self.maxcardinality)]
-            itemsets.extend([r[0] for r in fpgrowth(data_neg,supp=self.minsupport,zmax=self.maxcardinality)])
-        except TypeError:
-            itemsets = [r[0] for r in fpgrowth(data_pos,supp=self.minsupport,max=self.maxcardinality)]
-            itemsets.extend([r[0] for r in fpgrowth(data_neg,supp=self.minsupport,max=self.maxcardinality)])
-        itemsets = list(set(itemsets))
+        if self.fpgrowth_backend == "gpu" and not gpu_available() and self.verbose:
+            print "Warning: cupy is not installed, mining itemsets on the CPU instead."
+        #Merge the two classes, identifying itemsets by their sorted items so the same
+        #itemset reported in a different item order is not kept twice
+        itemsets = []
+        seen = set()
+        for lhs in chain(self._mine_itemsets(data_pos), self._mine_itemsets(data_neg)):
+            if lhs not in seen:
+                seen.add(lhs)
+                itemsets.append(lhs)
         if self.verbose:
             print len(itemsets),'rules mined'
-        #Now form the data-vs.-lhs set
-        #X[j] is the set of data points that contain itemset j (that is, satisfy rule j)
-        X = [ set() for j in range(len(itemsets)+1)]
-        X[0] = set(range(len(data))) #the default rule satisfies all data
-        for (j,lhs) in enumerate(itemsets):
-            X[j+1] = set([i for (i,xi) in enumerate(data) if set(lhs).issubset(xi)])
-        #now form lhs_len
-        lhs_len = [0]
-        for lhs in itemsets:
-            lhs_len.append(len(lhs))
-        nruleslen = Counter(lhs_len)
-        lhs_len = array(lhs_len)
         itemsets_all = ['null']
         itemsets_all.extend(itemsets)
+        self.itemsets = itemsets_all
+        #order the items of each rule rarest first, so that rule matching can stop early
+        item_support = Counter(item for xi in data for item in xi)
+        self._item_index, self._rule_items = itemset_index(itemsets, item_support)
+        #Now form the data-vs.-lhs bitsets
+        #row j of item_bitsets is the set of data points that contain itemset j (that is, satisfy rule j)
+        self.item_bitsets = self._to_bitsets(data)
+        #now form lhs_len, and nruleslen[k] the number of rules of length k
+        lhs_len = np.fromiter(chain([0], (len(lhs) for lhs in itemsets)), dtype=np.int32, count=len(itemsets)+1)
+        nruleslen = np.bincount(lhs_len, minlength=self.maxcardinality+1)
         
-        Xtrain,Ytrain,nruleslen,lhs_len,self.itemsets = (X,np.vstack((y, 1-y)).T.astype(int),nruleslen,lhs_len,itemsets_all)
+        #one-hot labels; uint8 is enough since the chains only need per-class counts
+        Ytrain = np.empty((len(y), 2), dtype=np.uint8)
+        Ytrain[:, 0] = y
+        Ytrain[:, 1] = 1 - y
+        Xtrain = self.item_bitsets
             
-        #Do MCMC
-        res,Rhat = run_bdl_multichain_serial(self.max_iter,self.thinning,self.alpha,self.listlengthprior,self.listwidthprior,Xtrain,Ytrain,nruleslen,lhs_len,self.maxcardinality,permsdic,self.burnin,self.n_chains,[None]*self.n_chains, verbose=self.verbose)
+        #Do MCMC (this runs the chains serially if there is only one worker)
+        res,Rhat = run_bdl_multichain_parallel(self.max_iter,self.thinning,self.alpha,self.listlengthprior,self.listwidthprior,Xtrain,Ytrain,nruleslen,lhs_len,self.maxcardinality,permsdic,self.burnin,self.n_chains,[None]*self.n_chains, n_workers=self.n_workers, verbose=self.verbose)
             
         #Merge the chains
         permsdic = merge_chains(res)
@@ -138,53 +162,122 @@ class RuleListClassifier(BaseEstimator):
         ###The point estimate, BRL-point
         self.d_star = get_point_estimate(permsdic,lhs_len,Xtrain,Ytrain,self.alpha,nruleslen,self.maxcardinality,self.listlengthprior,self.listwidthprior, verbose=self.verbose) #get the point estimate
         
-        if self.d_star:
+        if self.d_star is not None:
             #Compute the rule consequent
             self.theta, self.ci_theta = get_rule_rhs(Xtrain,Ytrain,self.d_star,self.alpha,True)
+            #Keep the rule list as compact contiguous arrays for prediction
+            self.d_star = np.asarray(self.d_star, dtype=np.int32)
+            self.theta = np.asarray(self.theta, dtype=np.float32)
+            self.ci_theta = np.asarray(self.ci_theta, dtype=np.float32)
+        self._str_cache = None
+        self.tostring(decimals=1)
             
         return self
     
+    def _mine_itemsets(self, data):
+        #Frequent itemsets of data as sorted tuples. This is a generator, so the second class
+        #is only mined once the first class's results have been consumed and released.
+        if self.fpgrowth_backend == "gpu" and gpu_available():
+            found = fpgrowth_gpu(data,supp=self.minsupport,zmax=self.maxcardinality)
+        else:
+            try:
+                found = fpgrowth(data,supp=self.minsupport,zmax=self.maxcardinality,report='')
+            except TypeError:
+                found = fpgrowth(data,supp=self.minsupport,max=self.maxcardinality,report='')
+        for r in found:
+            yield tuple(sorted(r[0]))
+    
     def discretize(self, X, y):
-        D = pd.DataFrame(np.hstack(( X, np.array(y).reshape((len(y), 1)) )), columns=list(self.feature_labels)+["y"])
+        #Build the frame column by column: no hstack copy of X, and y keeps its own dtype
+        X = np.asarray(X)
+        D = pd.DataFrame(dict((fl, X[:, i]) for (i, fl) in enumerate(self.feature_labels)), columns=list(self.feature_labels))
+        D["y"] = np.asarray(y)
         self.discretizer = MDLP_Discretizer(dataset=D, class_label="y")
+        #Keep the cutpoints and bin labels as arrays so predict can bin new data without pandas
+        self._cuts = []
+        self._bin_labels = []
+        for fl in self.feature_labels:
+            cuts = self.discretizer._cuts[fl]
+            if len(cuts) == 0:
+                labels = ['All', 'All']
+            else:
+                edges = [-np.inf] + cuts + [np.inf]
+                labels = ['%s_to_%s' % (str(edges[i]), str(edges[i+1])) for i in range(len(edges)-1)] + ['nan']
+            self._cuts.append(np.asarray(cuts, dtype=float))
+            self._bin_labels.append(np.array(labels, dtype=object))
         return self._prepend_feature_labels(np.array(self.discretizer._data)[:, :-1])
     
+    def _apply_cutpoints(self, X):
+        #Same bins as MDLP_Discretizer.apply_cutpoints: [cut_i, cut_i+1), with missing values labelled 'nan'.
+        #+inf is outside the last bin [cut_k, inf), so pd.cut labels it 'nan' as well.
+        X = np.asarray(X, dtype=float)
+        D = np.empty(X.shape, dtype=object)
+        for j in range(X.shape[1]):
+            bins = np.searchsorted(self._cuts[j], X[:, j], side='right')
+            bins[np.isnan(X[:, j]) | (X[:, j] == np.inf)] = -1
+            D[:, j] = self._bin_labels[j][bins]
+        return D
+    
     def _prepend_feature_labels(self, X):
-        Xl = np.copy(X).astype(str).tolist()
-        for i in range(len(Xl)):
-            for j in range(len(Xl[0])):
-                Xl[i][j] = self.feature_labels[j]+" : "+Xl[i][j]
-        return Xl
+        #fpgrowth and the itemset lookups expect lists of python strings, so build them
+        #in one pass rather than through intermediate numpy string arrays
+        prefixes = [fl+" : " for fl in self.feature_labels]
+        rows = X.tolist() if isinstance(X, np.ndarray) else X
+        return [[p+str(v) for (p, v) in izip(prefixes, row)] for row in rows]
     
     def __str__(self):
         return self.tostring(decimals=1)
         
     def tostring(self, decimals=1):
-        if self.d_star:
+        #the text of the last call is cached, since the rule list only changes on fit
+        key = (decimals, self.class1label)
+        if self._str_cache is None or self._str_cache[0] != key:
+            self._str_cache = (key, self._build_tostring(decimals))
+        return self._str_cache[1]
+        
+    def _build_tostring(self, decimals):
+        if self.d_star is not None:
             detect = ""
             if self.class1label != "class 1":
                 detect = "for detecting "+self.class1label
             header = "Trained RuleListClassifier "+detect+"\n"
             separator = "".join(["="]*len(header))+"\n"
-            s = ""
+            def pct(p):
+                #same text as str(np.round(p*100, decimals)): no trailing zeros, but at least one decimal
+                s = ("%.*f" % (decimals, np.round(p*100, decimals))).rstrip("0") if decimals > 0 else "%.0f." % np.round(p*100)
+                return s+"0" if s.endswith(".") else s
+            lines = []
             for i,j in enumerate(self.d_star):
                 if self.itemsets[j] != 'null':
-                    condition = "ELSE IF "+(" AND ".join([self.itemsets[j][k] for k in range(len(self.itemsets[j]))])) + " THEN"
+                    condition = "ELSE IF "+(" AND ".join(self.itemsets[j])) + " THEN"
                 else:
                     condition = "ELSE"
-                s += condition + " probability of "+self.class1label+": "+str(np.round(self.theta[i]*100,decimals)) + "% ("+str(np.round(self.ci_theta[i][0]*100,decimals))+"%-"+str(np.round(self.ci_theta[i][1]*100,decimals))+"%)\n"
-            return header+separator+s[5:]+separator[1:]
+                lines.append("%s probability of %s: %s%% (%s%%-%s%%)\n" % (condition, self.class1label,
+                    pct(float(self.theta[i])), pct(float(self.ci_theta[i][0])), pct(float(self.ci_theta[i][1]))))
+            return header+separator+"".join(lines)[5:]+separator[1:]
         else:
             return "(Untrained RuleListClassifier)"
         
-    def _to_itemset_indices(self, data):
-        #X[j] is the set of data points that contain itemset j (that is, satisfy rule j)
-        X = [set() for j in range(len(self.itemsets))]
-        X[0] = set(range(len(data))) #the default rule satisfies all data
-        for (j,lhs) in enumerate(self.itemsets):
-            if j>0:
-                X[j] = set([i for (i,xi) in enumerate(data) if set(lhs).issubset(xi)])
-        return X
+    def _to_bitsets(self, data):
+        #row j is the bitset of data points that contain itemset j (that is, satisfy rule j)
+        #the default rule satisfies all data
+        n_jobs = -1 if self.n_workers is None else self.n_workers
+        return np.vstack((full_bitset(len(data)), itemset_bitsets(data, self._item_index, self._rule_items, n_jobs=n_jobs)))
+        
+    def _predict_raw(self, X):
+        #theta of the first rule in d_star satisfied by each sample
+        if self.discretizer != None:
+            D = self._prepend_feature_labels(self._apply_cutpoints(X))
+        else:
+            D = X
+        
+        N = len(D)
+        #M[k,i] is whether sample i satisfies rule d_star[k]. Only the rules on the list are
+        #matched; it ends with the null rule, which every sample satisfies, so argmax finds
+        #the first rule each sample reaches.
+        bits = itemset_bitsets(D, self._item_index, self._rule_items[self.d_star[:-1]-1])
+        M = unpack_rows(np.vstack((bits, full_bitset(N))), N)
+        return np.asarray(self.theta, dtype=float)[M.argmax(axis=0)]
         
     def predict_proba(self, X):
         """Compute probabilities of possible outcomes for samples in X.
@@ -200,18 +293,8 @@ class RuleListClassifier(BaseEstimator):
             the model. The columns correspond to the classes in sorted
             order, as they appear in the attribute `classes_`.
         """
-        
-        if self.discretizer != None:
-            self.discretizer._data = pd.DataFrame(X, columns=self.feature_labels)
-            self.discretizer.apply_cutpoints()
-            D = self._prepend_feature_labels(np.array(self.discretizer._data)[:, :-1])
-        else:
-            D = X
-        
-        N = len(D)
-        X = self._to_itemset_indices(D[:])
-        P = preds_d_t(X, np.zeros((N, 1), dtype=int),self.d_star,self.theta)
-        return np.vstack((1-P, P)).T
+        P = self._predict_raw(X)
+        return np.column_stack((1-P, P))
         
     def predict(self, X):
         """Perform classification on samples in X.
@@ -225,7 +308,8 @@ class RuleListClassifier(BaseEstimator):
         y_pred : array, shape = [n_samples]
             Class labels for samples in X.
         """
-        return 1*(self.predict_proba(X)[:,0]>=0.5)
+        #same as predict_proba(X)[:,0] >= 0.5, without building the probability matrix
+        return 1*(self._predict_raw(X)<=0.5)
     
     def score(self, X, y, sample_weight=None):
         return sklearn.metrics.accuracy_score(y, self.predict(X), sample_weight=sample_weight)
@@ -0,0 +1,124 @@
+#Compare the bitset, array and numpy rewrites used by fit and predict against the
+#set-based and pandas code they replaced, on randomized inputs.
+#Run from the repository root with: python -m unittest discover -s tests -t .
+
+import unittest
+from collections import Counter, defaultdict
+import numpy as np
+import pandas as pd
+from LethamBRL.bitsets import pack_rows, unpack_rows, itemset_index, itemset_bitsets
+from LethamBRL.brl_core import _rule_usage, class_bitsets
+from LethamBRL.BRL_code import compute_rule_usage, mcmcchain, merge_chains, gelmanrubin, default_permsdic
+from RuleListClassifier import RuleListClassifier
+
+#Random transactions over the items i0..i(n_items-1), and up to n_itemsets distinct itemsets of 1 to 3 of those items
+def random_data(rng, n_points, n_items, n_itemsets):
+    data = [['i%d' % j for j in np.flatnonzero(row)] for row in rng.rand(n_points, n_items) < rng.rand(n_items)]
+    itemsets = set()
+    for k in range(n_itemsets):
+        itemsets.add(tuple(sorted('i%d' % j for j in rng.choice(n_items, rng.randint(1, min(n_items, 3)+1), replace=False))))
+    return data, sorted(itemsets)
+
+#X[j] is the set of data points that contain itemset j, as the set-based code built it
+def reference_sets(data, itemsets):
+    return [set(i for (i, xi) in enumerate(data) if set(lhs).issubset(xi)) for lhs in itemsets]
+
+#The sets of data points in each row of a bitset matrix
+def bitset_rows(bits, n):
+    return [set(np.flatnonzero(row).tolist()) for row in unpack_rows(bits, n)]
+
+#gelmanrubin and merge_chains as they were when each chain stored its own permsdic
+def reference_gelmanrubin(res):
+    m = len(res)
+    n = sum(val[1] for chain in res for val in res[chain]['permsdic'].itervalues())//m
+    phi_bar_j = dict((chain, sum(val[1]*val[0] for val in res[chain]['permsdic'].itervalues())/float(n)) for chain in res)
+    phi_bar = sum(phi_bar_j.values())/float(m)
+    B = sum((phi_bar_j[chain] - phi_bar)**2 for chain in res)*(n/float(m-1))
+    W = sum(sum(val[1]*(val[0] - phi_bar_j[chain])**2 for val in res[chain]['permsdic'].itervalues())/float(n-1) for chain in res)/float(m)
+    varhat = ((n-1)/float(n))*W + (1./float(n))*B
+    return np.sqrt(varhat/float(W))
+
+def reference_merge_chains(res):
+    permsdic = defaultdict(default_permsdic)
+    for n in res:
+        for perm, vals in res[n]['permsdic'].iteritems():
+            permsdic[perm][0] = vals[0]
+            permsdic[perm][1] += vals[1]
+    return permsdic
+
+class ItemsetBitsetsTest(unittest.TestCase):
+    def test_matches_sets(self):
+        rng = np.random.RandomState(0)
+        for case in range(20):
+            n = rng.randint(1, 200)
+            data, itemsets = random_data(rng, n, rng.randint(1, 10), rng.randint(1, 40))
+            expected = reference_sets(data, itemsets)
+            support = Counter(item for xi in data for item in xi)
+            for (order, n_jobs) in [(None, 1), (support, 1), (support, 2)]:
+                index, rule_items = itemset_index(itemsets, order)
+                bits = itemset_bitsets(data, index, rule_items, n_jobs=n_jobs, chunk=7)
+                self.assertEqual(bitset_rows(bits, n), expected)
+
+class RuleUsageTest(unittest.TestCase):
+    def test_matches_sets(self):
+        rng = np.random.RandomState(1)
+        for case in range(20):
+            n = rng.randint(1, 300)
+            data, itemsets = random_data(rng, n, rng.randint(1, 10), rng.randint(1, 30))
+            X_sets = [set(range(n))] + reference_sets(data, itemsets)
+            X_bits = pack_rows([[i in Xj for i in range(n)] for Xj in X_sets])
+            y = rng.rand(n) < 0.4
+            Y = np.column_stack((y, ~y)).astype(np.uint8)
+            for trial in range(5):
+                d = rng.permutation(len(X_sets)).tolist()
+                R = d.index(0)
+                expected = compute_rule_usage(d, R, X_sets, Y)
+                np.testing.assert_array_equal(compute_rule_usage(d, R, X_bits, Y), expected)
+                np.testing.assert_array_equal(_rule_usage(np.array(d[:R+1]), X_bits, class_bitsets(Y)), expected)
+
+class ChainsTest(unittest.TestCase):
+    def test_merge_and_gelmanrubin(self):
+        np.random.seed(2)
+        data, itemsets = random_data(np.random, 150, 8, 25)
+        X = pack_rows([[True]*150] + [[i in Xj for i in range(150)] for Xj in reference_sets(data, itemsets)])
+        y = np.random.rand(150) < 0.5
+        Y = np.column_stack((y, ~y)).astype(np.uint8)
+        lhs_len = np.array([0] + [len(lhs) for lhs in itemsets], dtype=np.int32)
+        nruleslen = np.bincount(lhs_len, minlength=4)
+        permsdic = defaultdict(default_permsdic)
+        res = dict((n, mcmcchain(400, 1, np.array([1., 1.]), 3., 1., X, Y, nruleslen, lhs_len, 3, permsdic, 100, 3, None)) for n in range(3))
+        #the per-chain permsdic that the chains used to return
+        res_old = {}
+        for n in res:
+            counts = np.bincount(res[n]['perms'], minlength=len(res[n]['keys']))
+            res_old[n] = {'permsdic': dict((perm, [lp, c]) for (perm, lp, c) in zip(res[n]['keys'], res[n]['logpost'], counts) if c > 0)}
+        self.assertAlmostEqual(gelmanrubin(res), reference_gelmanrubin(res_old), places=10)
+        merged = merge_chains(res)
+        expected = reference_merge_chains(res_old)
+        self.assertEqual(sorted(merged), sorted(expected))
+        for perm in expected:
+            self.assertEqual(list(merged[perm]), expected[perm])
+
+class ApplyCutpointsTest(unittest.TestCase):
+    def test_matches_pandas(self):
+        rng = np.random.RandomState(3)
+        X = rng.randn(300, 4)
+        X[:, 3] = 1. #no cuts, every value is 'All'
+        y = (X[:, 0] + 0.5*X[:, 1] > 0).astype(int)
+        clf = RuleListClassifier(verbose=False)
+        clf.feature_labels = ['ft%d' % (j+1) for j in range(4)]
+        clf.discretize(X, y)
+        T = rng.randn(500, 4)
+        T[::7, 0] = np.inf
+        T[::11, 1] = -np.inf
+        T[::13, 2] = np.nan
+        for j in range(3):
+            if len(clf._cuts[j]):
+                T[3::5, j] = rng.choice(clf._cuts[j], len(T[3::5, j])) #values on the bin edges
+        clf.discretizer._data = pd.DataFrame(T, columns=clf.feature_labels)
+        clf.discretizer.apply_cutpoints()
+        expected = [[str(v) for v in row] for row in np.array(clf.discretizer._data)]
+        self.assertEqual(clf._apply_cutpoints(T).tolist(), expected)
+
+if __name__ == '__main__':
+    unittest.main()
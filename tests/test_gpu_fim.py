@@ -0,0 +1,34 @@
+#Compare the dense Apriori miner behind the gpu backend (run on numpy) against PyFIM's fpgrowth.
+#Run from the repository root with: python -m unittest discover -s tests -t .
+
+import unittest
+import numpy as np
+from fim import fpgrowth
+from LethamBRL.gpu_fim import apriori_dense
+
+#The itemsets found by a miner, ignoring the order of the itemsets and of their items
+def itemsets(found):
+    return set(frozenset(r[0]) for r in found)
+
+class AprioriDenseTest(unittest.TestCase):
+    def assertSameItemsets(self, tracts, supp, zmax):
+        self.assertEqual(itemsets(apriori_dense(tracts, supp=supp, zmax=zmax, xp=np)),
+                         itemsets(fpgrowth(tracts, supp=supp, zmax=zmax, report='')))
+
+    def test_full_support_items(self):
+        #items in every transaction are only reported as part of a smaller-support itemset
+        tracts = [['a', 'b', 'c'], ['a', 'b'], ['a', 'c'], ['a', 'b', 'c'], ['a']]
+        self.assertSameItemsets(tracts, 10, 3)
+        self.assertEqual(apriori_dense([['a', 'b']]*3, supp=10, zmax=3, xp=np), [])
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        for case in range(100):
+            n = rng.randint(1, 40)
+            m = rng.randint(1, 8)
+            B = rng.rand(n, m) < 1.3*rng.rand(m) #some columns are set in every row
+            tracts = [['i%d' % j for j in np.flatnonzero(row)] for row in B]
+            self.assertSameItemsets(tracts, rng.choice([5, 10, 30, -2]), rng.randint(1, 5))
+
+if __name__ == '__main__':
+    unittest.main()